@@ -14,15 +14,32 @@
 #    limitations under the License.
 
 import enum
-import functools
 import glob
-from typing import List
-
+import hashlib
+import io
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from typing import Any, List, Optional
+
+import matter_idl.matter_idl_types
+import matter_idl.zapxml
 from matter_idl.matter_idl_types import *
 from matter_idl.zapxml import ParseSource, ParseXmls
 
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'matter_yamltests')
+# Number of parsed definitions kept in the cache directory, the least
+# recently used ones are removed when a new entry is written.
+_MAX_CACHE_ENTRIES = 4
+
+# Marks lookups that are not memoized yet, None being a valid result.
+_NOT_CACHED = object()
 
-class _ItemType(enum.Enum):
+
+class _ItemType(enum.IntEnum):
     Cluster = 0
     Request = 1
     Response = 2
@@ -31,59 +48,73 @@ class _ItemType(enum.Enum):
     Bitmap = 5
     Enum = 6
     Struct = 7
+    Type = 8
+
+
+class _ItemIndex:
+    """Lookup tables for one item type, keyed by (cluster, target) tuples.
+
+    by_name maps (cluster_name, target_name) directly to the item, so that a
+    lookup by name is a single probe. Items with an id are also indexed by
+    (cluster_id, target_id).
+    """
+    __slots__ = ('by_id', 'by_name', 'by_lowercase_name')
+
+    def __init__(self, with_ids: bool = True):
+        self.by_id: Optional[dict[tuple[int, int], Any]] = {} if with_ids else None
+        self.by_name: dict[tuple[str, str], Any] = {}
+        self.by_lowercase_name: dict[tuple[str, str], str] = {}
+
+    def index_lowercase_names(self):
+        """Map (cluster_name, lowercased target name) to the spec target name."""
+        self.by_lowercase_name = {}
+        for (cluster_name, name) in self.by_name:
+            self.by_lowercase_name.setdefault(
+                (cluster_name, name.lower()), name)
 
 
 class SpecDefinitions:
 
-    def __init__(self, sources: List[ParseSource]):
+    def __init__(self, sources: Optional[List[ParseSource]] = None, idl: Optional[Idl] = None):
         self.__clusters_by_id: dict[int, Cluster] = {}
-        self.__commands_by_id: dict[int, dict[int, Command]] = {}
-        self.__responses_by_id: dict[int, dict[int, Struct]] = {}
-        self.__attributes_by_id: dict[int, dict[int, Attribute]] = {}
-        self.__events_by_id: dict[int, dict[int, Event]] = {}
 
-        self.__clusters_by_name: dict[str, int] = {}
-        self.__commands_by_name: dict[str, int] = {}
-        self.__responses_by_name: dict[str, int] = {}
-        self.__attributes_by_name: dict[str, int] = {}
-        self.__events_by_name: dict[str, int] = {}
+        # Commands and attributes are what test steps are made of, so they
+        # are indexed right away. The other indexes are only built the first
+        # time they are needed, see __get_index.
+        commands = _ItemIndex()
+        attributes = _ItemIndex()
 
-        self.__bitmaps_by_name: dict[str, dict[str, Bitmap]] = {}
-        self.__enums_by_name: dict[str, dict[str, Enum]] = {}
-        self.__structs_by_name: dict[str, dict[str, Struct]] = {}
+        if idl is None:
+            idl = ParseXmls(sources)
 
-        idl = ParseXmls(sources)
+        # Several clusters may share a code (e.g. manufacturer specific
+        # samples), so the lazily built indexes walk the full cluster list
+        # rather than __clusters_by_id.
+        self.__clusters: List[Cluster] = idl.clusters
 
         for cluster in idl.clusters:
             code: int = cluster.code
+            # Every index shares the same interned cluster name object, which
+            # lets key comparisons succeed on identity.
+            cluster.name = sys.intern(cluster.name)
             name: str = cluster.name
             self.__clusters_by_id[code] = cluster
-            self.__commands_by_id[code] = {c.code: c for c in cluster.commands}
-            self.__responses_by_id[code] = {}
-            self.__attributes_by_id[code] = {
-                a.definition.code: a for a in cluster.attributes}
-            self.__events_by_id[code] = {e.code: e for e in cluster.events}
-
-            self.__clusters_by_name[name] = cluster.code
-            self.__commands_by_name[name] = {
-                c.name: c.code for c in cluster.commands}
-            self.__responses_by_name[name] = {}
-            self.__attributes_by_name[name] = {
-                a.definition.name: a.definition.code for a in cluster.attributes}
-            self.__events_by_name[name] = {
-                e.name: e.code for e in cluster.events}
-
-            self.__bitmaps_by_name[name] = {
-                b.name: b for b in cluster.bitmaps}
-            self.__enums_by_name[name] = {
-                e.name: e for e in cluster.enums}
-            self.__structs_by_name[name] = {
-                s.name: s for s in cluster.structs}
 
-            for struct in cluster.structs:
-                if struct.tag == StructTag.RESPONSE:
-                    self.__responses_by_id[code][struct.code] = struct
-                    self.__responses_by_name[name][struct.name] = struct.code
+            for c in cluster.commands:
+                commands.by_id[(code, c.code)] = c
+                commands.by_name[(name, c.name)] = c
+
+            for a in cluster.attributes:
+                attributes.by_id[(code, a.definition.code)] = a
+                attributes.by_name[(name, a.definition.name)] = a
+
+        self.__indexes: dict[_ItemType, _ItemIndex] = {}
+        self.__add_index(_ItemType.Request, commands)
+        self.__add_index(_ItemType.Attribute, attributes)
+
+        # Tests resolve the same names over and over again, memoize the
+        # lookups by name. Keyed on the arguments as given by the caller.
+        self.__lookup_cache: dict[tuple[_ItemType, str, str], Any] = {}
 
     def get_cluster_name(self, cluster_id: int) -> str:
         cluster = self.__clusters_by_id.get(cluster_id)
@@ -129,123 +160,227 @@ class SpecDefinitions:
         return self.__get_by_name(cluster_name, struct_name, _ItemType.Struct)
 
     def get_type_by_name(self, cluster_name: str, target_name: str):
-        bitmap = self.get_bitmap_by_name(cluster_name, target_name)
-        if bitmap:
-            return bitmap
-
-        enum = self.get_enum_by_name(cluster_name, target_name)
-        if enum:
-            return enum
-
-        struct = self.get_struct_by_name(cluster_name, target_name)
-        if struct:
-            return struct
-
-        return None
+        return self.__get_by_name(cluster_name, target_name, _ItemType.Type)
 
     def is_fabric_scoped(self, target) -> bool:
-        if hasattr(target, 'qualities'):
-            return bool(target.qualities & StructQuality.FABRIC_SCOPED)
-        return False
+        qualities = getattr(target, 'qualities', None)
+        return qualities is not None and bool(qualities & StructQuality.FABRIC_SCOPED)
 
     def is_nullable(self, target) -> bool:
-        if hasattr(target, 'qualities'):
-            return bool(target.qualities & FieldQuality.NULLABLE)
-        return False
+        qualities = getattr(target, 'qualities', None)
+        return qualities is not None and bool(qualities & FieldQuality.NULLABLE)
+
+    def __add_index(self, target_type: _ItemType, index: _ItemIndex):
+        index.index_lowercase_names()
+        self.__indexes[target_type] = index
+
+    def __get_index(self, target_type: _ItemType) -> _ItemIndex:
+        index = self.__indexes.get(target_type)
+        if index is None:
+            self.__LAZY_INDEXES[target_type](self)
+            index = self.__indexes[target_type]
+        return index
+
+    def __index_events(self):
+        events = _ItemIndex()
+        for cluster in self.__clusters:
+            for e in cluster.events:
+                events.by_id[(cluster.code, e.code)] = e
+                events.by_name[(cluster.name, e.name)] = e
+        self.__add_index(_ItemType.Event, events)
+
+    def __index_bitmaps(self):
+        bitmaps = _ItemIndex(with_ids=False)
+        for cluster in self.__clusters:
+            for b in cluster.bitmaps:
+                bitmaps.by_name[(cluster.name, b.name)] = b
+        self.__add_index(_ItemType.Bitmap, bitmaps)
+
+    def __index_enums(self):
+        enums = _ItemIndex(with_ids=False)
+        for cluster in self.__clusters:
+            for e in cluster.enums:
+                enums.by_name[(cluster.name, e.name)] = e
+        self.__add_index(_ItemType.Enum, enums)
+
+    def __index_structs(self):
+        # Responses are structs as well, index both in the same pass.
+        structs = _ItemIndex(with_ids=False)
+        responses = _ItemIndex()
+        for cluster in self.__clusters:
+            for struct in cluster.structs:
+                structs.by_name[(cluster.name, struct.name)] = struct
+                if struct.tag == StructTag.RESPONSE:
+                    responses.by_id[(cluster.code, struct.code)] = struct
+                    responses.by_name[(cluster.name, struct.name)] = struct
+        self.__add_index(_ItemType.Struct, structs)
+        self.__add_index(_ItemType.Response, responses)
+
+    def __index_types(self):
+        # Bitmaps, enums and structs share a single index for type lookups.
+        # When names collide, bitmaps win over enums which win over structs.
+        types = _ItemIndex(with_ids=False)
+        types.by_name = {
+            **self.__get_index(_ItemType.Struct).by_name,
+            **self.__get_index(_ItemType.Enum).by_name,
+            **self.__get_index(_ItemType.Bitmap).by_name,
+        }
+        self.__add_index(_ItemType.Type, types)
+
+    # Builders of the indexes created on first use. Kept at the class level
+    # as plain functions so that instances hold no bound methods and stay
+    # picklable.
+    __LAZY_INDEXES = {
+        _ItemType.Response: __index_structs,
+        _ItemType.Event: __index_events,
+        _ItemType.Bitmap: __index_bitmaps,
+        _ItemType.Enum: __index_enums,
+        _ItemType.Struct: __index_structs,
+        _ItemType.Type: __index_types,
+    }
 
     def __get_by_name(self, cluster_name: str, target_name: str, target_type: _ItemType):
         if not cluster_name or not target_name:
             return None
 
-        # The idl parser remove spaces
-        cluster_name = cluster_name.replace(' ', '')
+        key = (target_type, cluster_name, target_name)
+        target = self.__lookup_cache.get(key, _NOT_CACHED)
+        if target is not _NOT_CACHED:
+            return target
+
+        # The idl parser remove spaces. Only pay for the copy when there is
+        # actually something to remove, and intern the result so that it is
+        # the very same object as the cluster name stored in the indexes.
+        if ' ' in cluster_name:
+            cluster_name = cluster_name.replace(' ', '')
+        cluster_name = sys.intern(cluster_name)
+
+        # A single probe resolves both the cluster and the target: a missing
+        # cluster simply never matches any key.
+        index = self.__get_index(target_type)
+        target = index.by_name.get((cluster_name, target_name))
+        if target is None:
+            self.__enforce_casing(cluster_name, target_name,
+                                  index.by_lowercase_name)
+
+        self.__lookup_cache[key] = target
+        return target
 
-        cluster_id = self.__clusters_by_name.get(cluster_name)
-        if cluster_id is None:
+    def __get_by_id(self, cluster_id: int, target_id: int, target_type: _ItemType):
+        index = self.__get_index(target_type)
+        if index.by_id is None:
             return None
 
-        target = None
-
-        if target_type == _ItemType.Request:
-            self.__enforce_casing(
-                target_name, self.__commands_by_name.get(cluster_name))
-            target_id = self.__commands_by_name.get(
-                cluster_name).get(target_name)
-            target = self.__get_by_id(cluster_id, target_id, target_type)
-        elif target_type == _ItemType.Response:
-            self.__enforce_casing(
-                target_name, self.__responses_by_name.get(cluster_name))
-            target_id = self.__responses_by_name.get(
-                cluster_name).get(target_name)
-            target = self.__get_by_id(cluster_id, target_id, target_type)
-        elif target_type == _ItemType.Event:
-            self.__enforce_casing(
-                target_name, self.__events_by_name.get(cluster_name))
-            target_id = self.__events_by_name.get(
-                cluster_name).get(target_name)
-            target = self.__get_by_id(cluster_id, target_id, target_type)
-        elif target_type == _ItemType.Attribute:
-            self.__enforce_casing(
-                target_name, self.__attributes_by_name.get(cluster_name))
-            target_id = self.__attributes_by_name.get(
-                cluster_name).get(target_name)
-            target = self.__get_by_id(cluster_id, target_id, target_type)
-        elif target_type == _ItemType.Bitmap:
-            self.__enforce_casing(
-                target_name, self.__bitmaps_by_name.get(cluster_name))
-            target = self.__bitmaps_by_name.get(cluster_name).get(target_name)
-        elif target_type == _ItemType.Enum:
-            self.__enforce_casing(
-                target_name, self.__enums_by_name.get(cluster_name))
-            target = self.__enums_by_name.get(cluster_name).get(target_name)
-        elif target_type == _ItemType.Struct:
-            self.__enforce_casing(
-                target_name, self.__structs_by_name.get(cluster_name))
-            target = self.__structs_by_name.get(cluster_name).get(target_name)
+        return index.by_id.get((cluster_id, target_id))
 
-        return target
+    def __enforce_casing(self, cluster_name: str, target_name: str, lowercase_targets: dict):
+        name = lowercase_targets.get((cluster_name, target_name.lower()))
+        if name is not None:
+            raise KeyError(
+                f'Unknown target {target_name}. Did you mean {name} ?')
 
-    def __get_by_id(self, cluster_id: int, target_id: int, target_type: str):
-        targets = None
 
-        if target_type == _ItemType.Request:
-            targets = self.__commands_by_id.get(cluster_id)
-        elif target_type == _ItemType.Response:
-            targets = self.__responses_by_id.get(cluster_id)
-        elif target_type == _ItemType.Event:
-            targets = self.__events_by_id.get(cluster_id)
-        elif target_type == _ItemType.Attribute:
-            targets = self.__attributes_by_id.get(cluster_id)
+def _read_file(filename: str) -> bytes:
+    with open(filename, 'rb') as f:
+        return f.read()
 
-        if targets is None:
-            return None
 
-        return targets.get(target_id)
+def _cache_key(filenames: List[str], contents: List[bytes]) -> str:
+    h = hashlib.sha256()
 
-    def __enforce_casing(self, target_name: str, targets: list):
-        if targets.get(target_name) is not None:
-            return
+    # The cached Idl is only valid for the parser that produced it.
+    zapxml_dir = os.path.dirname(matter_idl.zapxml.__file__)
+    parser_filenames = sorted(glob.glob(os.path.join(
+        zapxml_dir, '**', '*.py'), recursive=True))
+    parser_filenames.append(matter_idl.matter_idl_types.__file__)
+    for filename in parser_filenames:
+        h.update(_read_file(filename))
 
-        for name in targets:
-            if name.lower() == target_name.lower():
-                raise KeyError(
-                    f'Unknown target {target_name}. Did you mean {name} ?')
+    for filename, content in zip(filenames, contents):
+        h.update(f'{filename}:{len(content)}\n'.encode())
+        h.update(content)
 
+    return h.hexdigest()
 
-def SpecDefinitionsFromPath(path: str):
-    def sort_with_global_attribute_first(a, b):
-        if a.endswith('global-attributes.xml'):
-            return -1
-        elif b.endswith('global-attributes.xml'):
-            return 1
-        elif a > b:
-            return 1
-        elif a == b:
-            return 0
-        elif a < b:
-            return -1
 
+def _load_cached_idl(cache_file: str) -> Optional[Idl]:
+    try:
+        with open(cache_file, 'rb') as f:
+            idl = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f'Ignoring unreadable cache {cache_file}: {e}')
+        return None
+
+    # Mark the entry as recently used so that pruning keeps it around.
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+
+    return idl
+
+
+def _prune_cache(cache_dir: str):
+    entries = glob.glob(os.path.join(cache_dir, '*.pkl'))
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for entry in entries[_MAX_CACHE_ENTRIES:]:
+        os.unlink(entry)
+
+
+def _store_cached_idl(cache_file: str, idl: Idl):
+    cache_dir = os.path.dirname(cache_file)
+    temp_file = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that concurrent runs never see
+        # a partially written cache.
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+            temp_file = f.name
+            pickle.dump(idl, f)
+        os.replace(temp_file, cache_file)
+        temp_file = None
+        _prune_cache(cache_dir)
+    except Exception as e:
+        logging.warning(f'Failed to write cache {cache_file}: {e}')
+    finally:
+        if temp_file is not None:
+            try:
+                os.unlink(temp_file)
+            except OSError:
+                pass
+
+
+def SpecDefinitionsFromPath(path: str, cache_dir: Optional[str] = _DEFAULT_CACHE_DIR):
+    """Load the spec definitions from the XML files matching path.
+
+    Params:
+       path - glob pattern of the XML files to load
+       cache_dir - directory where parsed definitions are cached, keyed by
+                   the content of the XML files. Only the most recently
+                   used entries are kept. None disables the cache.
+    """
     filenames = glob.glob(path, recursive=False)
-    filenames.sort(key=functools.cmp_to_key(sort_with_global_attribute_first))
-    sources = [ParseSource(source=name) for name in filenames]
-    return SpecDefinitions(sources)
+    # global-attributes.xml needs to be parsed first, the rest is sorted by name.
+    filenames.sort(key=lambda x: (
+        not x.endswith('global-attributes.xml'), x))
+
+    contents = [_read_file(name) for name in filenames]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir, _cache_key(filenames, contents) + '.pkl')
+        idl = _load_cached_idl(cache_file)
+        if idl is not None:
+            return SpecDefinitions(idl=idl)
+
+    sources = [ParseSource(source=io.BytesIO(content), name=name)
+               for name, content in zip(filenames, contents)]
+    idl = ParseXmls(sources)
+
+    if cache_file is not None:
+        _store_cached_idl(cache_file, idl)
+
+    return SpecDefinitions(idl=idl)
@@ -14,8 +14,13 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import copy
 import io
+import os
+import pickle
+import tempfile
 import unittest
+import unittest.mock
 
 from matter_yamltests.definitions import *
 
@@ -175,6 +180,52 @@ source_struct = '''<?xml version="1.0"?>
   </configurator>
 '''
 
+source_global_attribute = '''<?xml version="1.0"?>
+  <configurator>
+    <global>
+      <attribute side="server" code="0xFFFD" type="boolean">TestGlobalAttribute</attribute>
+    </global>
+  </configurator>
+'''
+
+source_attribute_with_global = '''<?xml version="1.0"?>
+  <configurator>
+    <cluster>
+      <name>Test</name>
+      <code>0x1234</code>
+
+      <globalAttribute side="server" code="0xFFFD" value="true"/>
+      <attribute code="0x0" type="boolean">TestAttribute</attribute>
+
+    </cluster>
+  </configurator>
+'''
+
+source_clusters_with_same_code = '''<?xml version="1.0"?>
+  <configurator>
+    <struct name="TestStruct">
+        <cluster code="0x1234"/>
+        <item name="a" type="boolean"/>
+    </struct>
+
+    <cluster>
+      <name>Test</name>
+      <code>0x1234</code>
+
+      <command source="client" code="0x0" name="TestCommand"></command>
+      <event code="0x0" name="TestEvent" priority="info" side="server"></event>
+    </cluster>
+
+    <cluster>
+      <name>TestOther</name>
+      <code>0x1234</code>
+
+      <command source="client" code="0x0" name="TestOtherCommand"></command>
+      <event code="0x0" name="TestOtherEvent" priority="info" side="server"></event>
+    </cluster>
+  </configurator>
+'''
+
 
 class TestSpecDefinitions(unittest.TestCase):
     def test_cluster_name(self):
@@ -375,6 +426,48 @@ class TestSpecDefinitions(unittest.TestCase):
         self.assertIsInstance(definitions.get_type_by_name(
             'Test', 'TestStruct'), Struct)
 
+    def test_get_by_name_is_memoized(self):
+        definitions = SpecDefinitions(
+            [ParseSource(source=io.StringIO(source_command), name='source_command')])
+        command = definitions.get_command_by_name('Test', 'TestCommand')
+        self.assertIs(definitions.get_command_by_name(
+            'Test', 'TestCommand'), command)
+        self.assertIsNone(definitions.get_command_by_name(
+            'Test', 'TestWrongCommand'))
+        self.assertIsNone(definitions.get_command_by_name(
+            'Test', 'TestWrongCommand'))
+        for _ in range(2):
+            self.assertRaises(KeyError, definitions.get_command_by_name,
+                              'Test', 'testcommand')
+
+    def test_pickle_and_deepcopy(self):
+        definitions = SpecDefinitions(
+            [ParseSource(source=io.StringIO(source_struct), name='source_struct')])
+        self.assertIsInstance(definitions.get_struct_by_name(
+            'Test', 'TestStruct'), Struct)
+
+        for other in [pickle.loads(pickle.dumps(definitions)), copy.deepcopy(definitions)]:
+            struct = other.get_struct_by_name('Test', 'TestStruct')
+            self.assertIsInstance(struct, Struct)
+            self.assertIsNot(struct, definitions.get_struct_by_name(
+                'Test', 'TestStruct'))
+            self.assertIsNone(other.get_enum_by_name('Test', 'TestEnum'))
+            self.assertRaises(KeyError, other.get_struct_by_name,
+                              'Test', 'teststruct')
+
+    def test_clusters_with_same_code(self):
+        definitions = SpecDefinitions(
+            [ParseSource(source=io.StringIO(source_clusters_with_same_code), name='source_clusters_with_same_code')])
+        for cluster_name in ['Test', 'TestOther']:
+            self.assertIsInstance(definitions.get_command_by_name(
+                cluster_name, f'{cluster_name}Command'), Command)
+            self.assertIsInstance(definitions.get_event_by_name(
+                cluster_name, f'{cluster_name}Event'), Event)
+            self.assertIsInstance(definitions.get_struct_by_name(
+                cluster_name, 'TestStruct'), Struct)
+            self.assertIsInstance(definitions.get_type_by_name(
+                cluster_name, 'TestStruct'), Struct)
+
     def test_is_fabric_scoped(self):
         definitions = SpecDefinitions(
             [ParseSource(source=io.StringIO(source_struct), name='source_struct')])
@@ -386,6 +479,73 @@ class TestSpecDefinitions(unittest.TestCase):
             'Test', 'TestStructFabricScoped')
         self.assertTrue(definitions.is_fabric_scoped(struct))
 
+    def test_spec_definitions_from_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Named so that the cluster file sorts before the global one.
+            for filename, source in [('a-test.xml', source_attribute_with_global),
+                                     ('global-attributes.xml', source_global_attribute)]:
+                with open(os.path.join(directory, filename), 'w') as f:
+                    f.write(source)
+
+            definitions = SpecDefinitionsFromPath(
+                os.path.join(directory, '*.xml'), cache_dir=None)
+            self.assertEqual(definitions.get_attribute_name(
+                0x1234, 0x0), 'TestAttribute')
+            self.assertEqual(definitions.get_attribute_name(
+                0x1234, 0xFFFD), 'TestGlobalAttribute')
+
+    def test_spec_definitions_from_path_cache(self):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(directory, '*.xml')
+            with open(os.path.join(directory, 'test.xml'), 'w') as f:
+                f.write(source_command)
+
+            definitions = SpecDefinitionsFromPath(path, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(definitions.get_command_name(
+                0x1234, 0x0), 'TestCommand')
+
+            definitions = SpecDefinitionsFromPath(path, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(definitions.get_command_name(
+                0x1234, 0x0), 'TestCommand')
+
+            # Changing the content of the XML files invalidates the cache.
+            with open(os.path.join(directory, 'test.xml'), 'w') as f:
+                f.write(source_event)
+
+            definitions = SpecDefinitionsFromPath(path, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertIsNone(definitions.get_command_name(0x1234, 0x0))
+            self.assertEqual(definitions.get_event_name(
+                0x1234, 0x0), 'TestEvent')
+
+    def test_spec_definitions_from_path_cache_write_failure(self):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cache_dir:
+            with open(os.path.join(directory, 'test.xml'), 'w') as f:
+                f.write(source_command)
+
+            with unittest.mock.patch('pickle.dump', side_effect=pickle.PicklingError('test')):
+                definitions = SpecDefinitionsFromPath(
+                    os.path.join(directory, '*.xml'), cache_dir=cache_dir)
+            self.assertEqual(definitions.get_command_name(
+                0x1234, 0x0), 'TestCommand')
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_spec_definitions_from_path_cache_pruning(self):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(directory, '*.xml')
+            for code in range(6):
+                with open(os.path.join(directory, 'test.xml'), 'w') as f:
+                    f.write(source_command.replace('0x1234', f'0x{code:04X}'))
+                SpecDefinitionsFromPath(path, cache_dir=cache_dir)
+                # Make sure entries do not share the same mtime.
+                for entry in os.listdir(cache_dir):
+                    entry = os.path.join(cache_dir, entry)
+                    os.utime(entry, (0, os.path.getmtime(entry) - 1))
+
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
 
 if __name__ == '__main__':
     unittest.main()